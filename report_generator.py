@@ -1,18 +1,54 @@
+import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Plots are only saved to files, so skip GUI backend probing
 import matplotlib.pyplot as plt
+from matplotlib.ticker import MaxNLocator
 import seaborn as sns
 from openpyxl import Workbook
 from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.cell.cell import MergedCell
+from openpyxl.cell import Cell, WriteOnlyCell
+from openpyxl.utils import get_column_letter
 import os
 
+# Shared cell styles, created once and reused by every sheet
+HEADER_FILL = PatternFill(start_color="DDEBF7", end_color="DDEBF7", fill_type="solid")
+HEADER_FONT = Font(bold=True)
+HEADER_BORDER = Border(bottom=Side(style='medium'))
+SILENT_FILL = PatternFill(start_color="E2EFDA", end_color="E2EFDA", fill_type="solid")
+MISSENSE_FILL = PatternFill(start_color="FCE4D6", end_color="FCE4D6", fill_type="solid")
+
+# Column letters by 1-based column index, enough for every report sheet
+COL_LETTERS = [None] + [get_column_letter(i) for i in range(1, 50)]
+
+def sort_by_sample(mutations_df):
+    """Sort mutations by sample and position, skipping the sort if they already are."""
+    keys = ['sample', 'nucleotide_position']
+    # The aligner writes its output in this order, so usually this check is all that runs
+    if pd.MultiIndex.from_frame(mutations_df[keys]).is_monotonic_increasing:
+        return mutations_df
+    return mutations_df.sort_values(keys)
+
+def set_column_widths(ws, df, headers, max_widths=None):
+    """Size each column to its longest header or non-empty value in df."""
+    max_widths = max_widths or {}
+    for i, (header, col) in enumerate(zip(headers, df.columns)):
+        values = df[col][df[col].astype(bool)]
+        width = len(str(header)) if header else 0
+        if len(values):
+            width = max(width, values.astype(str).str.len().max())
+        width = min(width, max_widths.get(i, width))
+        
+        # Set column widths with some padding
+        if width:
+            ws.column_dimensions[COL_LETTERS[i + 1]].width = width + 2
+
 def generate_excel_report(mutations_df, output_file):
     """Generate a formatted Excel report with mutation data."""
     try:
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Mutation Summary"
+        # Write-only workbooks stream rows to disk instead of keeping every cell in memory
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(title="Mutation Summary")
         
         #TODO: vllt wieder rein aber macht nur probleme
         # Add title
@@ -22,83 +58,95 @@ def generate_excel_report(mutations_df, output_file):
         #ws['A1'].alignment = Alignment(horizontal='center')
         
         # Add headers with formatting
-        header_fill = PatternFill(start_color="DDEBF7", end_color="DDEBF7", fill_type="solid")
-        header_font = Font(bold=True)
-        header_border = Border(bottom=Side(style='medium'))
-        
         headers = ['Sample', 'Orientation', 'Nucleotide Pos', 'Original Codon', 
                    'Mutated Codon', 'AA Pos', 'Original AA', 'Mutated AA', 
                    'Silent?', 'Mutation Type']
         
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=3, column=col, value=header)
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.border = header_border
+        header_row = []
+        for header in headers:
+            cell = WriteOnlyCell(ws, value=header)
+            cell.fill = HEADER_FILL
+            cell.font = HEADER_FONT
+            cell.border = HEADER_BORDER
+            header_row.append(cell)
+        
+        sorted_mutations = sort_by_sample(mutations_df)
+        
+        # Write-only sheets only accept column widths before the first row is appended,
+        # so every sheet sizes its columns from the source data before writing it
+        set_column_widths(ws, sorted_mutations, headers)
+        
+        # Headers go on row 3
+        ws.append([])
+        ws.append([])
+        ws.append(header_row)
         
         # Add data
-        current_sample = None
-        row_offset = 0
+        data_rows = sorted_mutations.values.tolist()
         
-        sorted_mutations = mutations_df.sort_values(['sample', 'nucleotide_position'])
+        # Highlight silent mutations in green, missense in yellow
+        highlights = zip(sorted_mutations['is_silent'].values, sorted_mutations['mutation_type'].values)
+        for r_idx, (silent, mutation_type) in enumerate(highlights):
+            if silent == True:  # Silent column
+                cell = data_rows[r_idx][8] = WriteOnlyCell(ws, value=data_rows[r_idx][8])
+                cell.fill = SILENT_FILL
+            elif mutation_type == "Missense":  # Mutation type column
+                cell = data_rows[r_idx][9] = WriteOnlyCell(ws, value=data_rows[r_idx][9])
+                cell.fill = MISSENSE_FILL
         
-        for r_idx, row in enumerate(dataframe_to_rows(sorted_mutations, index=False, header=False), 4):
-            actual_row = r_idx + row_offset
-            
+        current_sample = None
+        for row in data_rows:
             # Check if we're starting a new sample
             if current_sample is not None and row[0] != current_sample:
                 # Insert blank row
-                for c_idx in range(1, len(headers) + 1):
-                    ws.cell(row=actual_row, column=c_idx, value="")
-                row_offset += 1
-                actual_row += 1
+                ws.append([""] * len(headers))
             
             current_sample = row[0]
-            
-            for c_idx, value in enumerate(row, 1):
-                cell = ws.cell(row=actual_row, column=c_idx, value=value)
-                
-                # Highlight silent mutations in green, missense in yellow
-                if c_idx == 9 and value == True:  # Silent column
-                    cell.fill = PatternFill(start_color="E2EFDA", end_color="E2EFDA", fill_type="solid")
-                elif c_idx == 10 and value == "Missense":  # Mutation type column
-                    cell.fill = PatternFill(start_color="FCE4D6", end_color="FCE4D6", fill_type="solid")
+            ws.append(row)
         
         # Add summary sheet
         summary_ws = wb.create_sheet(title="Summary Statistics")
         
         # Sample count
         sample_count = mutations_df['sample'].nunique()
-        summary_ws['A1'] = "Total Samples Analyzed:"
-        summary_ws['B1'] = sample_count
         
         # Mutation counts
         total_mutations = len(mutations_df)
         silent_mutations = mutations_df['is_silent'].sum()
         missense_mutations = total_mutations - silent_mutations
         
-        summary_ws['A3'] = "Mutation Statistics"
-        summary_ws['A3'].font = Font(bold=True)
-        
-        summary_ws['A4'] = "Total Mutations:"
-        summary_ws['B4'] = total_mutations
-        
-        summary_ws['A5'] = "Silent Mutations:"
-        summary_ws['B5'] = silent_mutations
-        
-        summary_ws['A6'] = "Missense Mutations:"
-        summary_ws['B6'] = missense_mutations
+        stats_title = WriteOnlyCell(summary_ws, value="Mutation Statistics")
+        stats_title.font = HEADER_FONT
         
         # Add per-sample statistics
-        summary_ws['A8'] = "Mutations per Sample"
-        summary_ws['A8'].font = Font(bold=True)
+        per_sample_title = WriteOnlyCell(summary_ws, value="Mutations per Sample")
+        per_sample_title.font = HEADER_FONT
         
-        sample_stats = mutations_df.groupby('sample').size().reset_index()
+        sample_stats = sorted_mutations.groupby('sample', sort=False).size().reset_index()
         sample_stats.columns = ['Sample', 'Mutation Count']
         
-        for r_idx, row in enumerate(dataframe_to_rows(sample_stats, index=False), 9):
-            for c_idx, value in enumerate(row, 1):
-                summary_ws.cell(row=r_idx, column=c_idx, value=value)
+        overview_rows = [
+            ["Total Samples Analyzed:", sample_count],
+            [],
+            [stats_title],
+            ["Total Mutations:", total_mutations],
+            ["Silent Mutations:", silent_mutations],
+            ["Missense Mutations:", missense_mutations],
+            [],
+            [per_sample_title]
+        ]
+        
+        # Size columns from the overview's plain values and the per-sample table
+        overview_values = pd.DataFrame(
+            [[value.value if isinstance(value, Cell) else value for value in row] for row in overview_rows],
+            columns=sample_stats.columns, dtype=object)
+        set_column_widths(summary_ws, pd.concat([overview_values, sample_stats]), sample_stats.columns)
+        
+        for row in overview_rows:
+            summary_ws.append(row)
+        summary_ws.append(list(sample_stats.columns))
+        for row in sample_stats.itertuples(index=False, name=None):
+            summary_ws.append(row)
         
         # Add codon mutation analysis sheet
         try:
@@ -106,17 +154,24 @@ def generate_excel_report(mutations_df, output_file):
             print("Creating Codon Analysis sheet...")
             
             # Group mutations by codon position and analyze frequency
-            codon_mutations = mutations_df.groupby(['nucleotide_position', 'original_codon', 'mutated_codon']).agg({
-                'sample': ['count', lambda x: ', '.join(sorted(set(x)))],
-                'original_aa': 'first',
-                'mutated_aa': 'first',
-                'is_silent': 'first',
-                'aa_position': 'first'  # Add amino acid position
-            }).reset_index()
+            codon_keys = ['nucleotide_position', 'original_codon', 'mutated_codon']
+            codon_mutations = mutations_df.groupby(codon_keys).agg(
+                occurrence_count=('sample', 'count'),
+                aa_position=('aa_position', 'first'),
+                original_aa=('original_aa', 'first'),
+                mutated_aa=('mutated_aa', 'first'),
+                is_silent=('is_silent', 'first')
+            )
+            
+            # Distinct samples per codon change, joined in sorted_mutations (sample) order
+            unique_samples = sorted_mutations.drop_duplicates(codon_keys + ['sample'])
+            codon_mutations['samples'] = unique_samples.groupby(codon_keys)['sample'].agg(', '.join)
+            codon_mutations = codon_mutations.reset_index()
             
+            # AA Pos goes before Original AA and Samples at the end
             codon_mutations.columns = ['Position', 'Original Codon', 'Mutated Codon', 
-                                      'Occurrence Count', 'Samples', 'Original AA', 
-                                      'Mutated AA', 'Silent', 'AA Pos']
+                                      'Occurrence Count', 'AA Pos', 'Original AA', 
+                                      'Mutated AA', 'Silent', 'Samples']
             
             # Sort by position and occurrence count
             codon_mutations = codon_mutations.sort_values(['Position', 'Occurrence Count'], ascending=[True, False])
@@ -125,25 +180,27 @@ def generate_excel_report(mutations_df, output_file):
             codon_headers = ['Position', 'Original Codon', 'Mutated Codon', 'Occurrence Count', 
                             'AA Pos', 'Original AA', 'Mutated AA', 'Silent', 'Samples']
             
-            for col, header in enumerate(codon_headers, 1):
-                cell = codon_ws.cell(row=1, column=col, value=header)
-                cell.font = Font(bold=True)
-                cell.fill = PatternFill(start_color="DDEBF7", end_color="DDEBF7", fill_type="solid")
-                cell.border = Border(bottom=Side(style='medium'))
+            header_row = []
+            for header in codon_headers:
+                cell = WriteOnlyCell(codon_ws, value=header)
+                cell.font = HEADER_FONT
+                cell.fill = HEADER_FILL
+                cell.border = HEADER_BORDER
+                header_row.append(cell)
             
-            # Reorder columns to put AA Pos before Original AA and Samples at the end
-            codon_mutations = codon_mutations[['Position', 'Original Codon', 'Mutated Codon', 
-                                              'Occurrence Count', 'AA Pos', 'Original AA', 
-                                              'Mutated AA', 'Silent', 'Samples']]
+            set_column_widths(codon_ws, codon_mutations, codon_headers)
+            codon_ws.append(header_row)
             
             # Add data
-            for r_idx, row in enumerate(dataframe_to_rows(codon_mutations, index=False, header=False), 2):
-                for c_idx, value in enumerate(row, 1):
-                    cell = codon_ws.cell(row=r_idx, column=c_idx, value=value)
-                    
-                    # Highlight silent mutations in green
-                    if c_idx == 8 and value == True:  # Silent column (now at position 8)
-                        cell.fill = PatternFill(start_color="E2EFDA", end_color="E2EFDA", fill_type="solid")
+            data_rows = codon_mutations.values.tolist()
+            
+            # Highlight silent mutations in green
+            for r_idx, silent in enumerate(codon_mutations['Silent'].values):
+                if silent == True:  # Silent column (now at position 8)
+                    cell = data_rows[r_idx][7] = WriteOnlyCell(codon_ws, value=data_rows[r_idx][7])
+                    cell.fill = SILENT_FILL
+            for row in data_rows:
+                codon_ws.append(row)
             print("Codon Analysis sheet completed")
         except Exception as e:
             print(f"Error creating Codon Analysis sheet: {e}")
@@ -154,19 +211,43 @@ def generate_excel_report(mutations_df, output_file):
             print("Creating Variant Analysis sheet...")
             
             # Identify unique mutation patterns (variants)
-            # Convert mutations to a format that can be used for grouping
-            def get_mutation_signature(group):
-                return frozenset([(row['nucleotide_position'], row['original_codon'], row['mutated_codon']) 
-                                 for _, row in group.iterrows()])
+            # A sample's signature is its set of distinct (position, original, mutated) mutations;
+            # dropping repeats and sorting on every key makes each set's row order canonical
+            signature_cols = ['nucleotide_position', 'original_codon', 'mutated_codon']
+            signature_rows = sorted_mutations.drop_duplicates(['sample'] + signature_cols)
+            signature_rows = signature_rows.sort_values(['sample'] + signature_cols)
+            
+            # Each mutation packs into a fixed-width record, and the signature is the raw bytes
+            # of the sample's records
+            records = np.empty(len(signature_rows), dtype=[('pos', '>i4'), ('orig', 'S3'), ('mut', 'S3')])
+            records['pos'] = signature_rows['nucleotide_position'].values
+            records['orig'] = signature_rows['original_codon'].values.astype('S3')
+            records['mut'] = signature_rows['mutated_codon'].values.astype('S3')
+            record_bytes = records.tobytes()
+            
+            # Row ranges of each sample's block in signature_rows
+            sample_names = signature_rows['sample'].values
+            is_start = np.ones(len(sample_names), dtype=bool)
+            is_start[1:] = sample_names[1:] != sample_names[:-1]
+            starts = np.flatnonzero(is_start)
+            ends = np.append(starts[1:], len(sample_names))
+            signature_values = signature_rows[signature_cols].values
             
             # Group samples by their mutation patterns
             sample_groups = {}
-            for sample, group in mutations_df.groupby('sample'):
-                signature = get_mutation_signature(group)
-                if signature in sample_groups:
-                    sample_groups[signature].append(sample)
-                else:
-                    sample_groups[signature] = [sample]
+            variant_mutations = {}
+            for start, end in zip(starts, ends):
+                signature = record_bytes[start * records.itemsize:end * records.itemsize]
+                if signature not in sample_groups:
+                    sample_groups[signature] = []
+                    variant_mutations[signature] = signature_values[start:end].tolist()
+                sample_groups[signature].append(sample_names[start])
+            
+            # Amino acid change for each distinct mutation, keyed like the signature entries
+            mutation_lookup = {
+                (row.nucleotide_position, row.original_codon, row.mutated_codon): (row.original_aa, row.mutated_aa)
+                for row in mutations_df.drop_duplicates(signature_cols).itertuples(index=False)
+            }
             
             # Create variant data for the sheet
             variant_data = []
@@ -182,17 +263,13 @@ def generate_excel_report(mutations_df, output_file):
                 
                 # Get mutation details for this variant
                 mutation_details = []
-                # Convert signature to list and sort by position (first element of each tuple)
-                sorted_signature = sorted(signature, key=lambda x: x[0])
-                for pos, orig, mut in sorted_signature:
-                    mutation_row = mutations_df[(mutations_df['nucleotide_position'] == pos) & 
-                                               (mutations_df['original_codon'] == orig) & 
-                                               (mutations_df['mutated_codon'] == mut)].iloc[0]
-                    mutation_details.append(f"{pos}: {orig}->{mut} ({mutation_row['original_aa']}->{mutation_row['mutated_aa']})")
+                for pos, orig, mut in variant_mutations[signature]:
+                    orig_aa, mut_aa = mutation_lookup[(pos, orig, mut)]
+                    mutation_details.append(f"{pos}: {orig}->{mut} ({orig_aa}->{mut_aa})")
                 
                 mutation_summary = "; ".join(mutation_details)
                 
-                variant_data.append([variant_name, sample_count, sample_list, len(signature), mutation_summary])
+                variant_data.append([variant_name, sample_count, sample_list, len(mutation_details), mutation_summary])
             
             # Sort variants by frequency
             variant_data.sort(key=lambda x: x[1], reverse=True)
@@ -200,11 +277,13 @@ def generate_excel_report(mutations_df, output_file):
             # Add headers
             variant_headers = ['Variant', 'Frequency', 'Mutation Count', 'Mutations', 'Samples']
             
-            for col, header in enumerate(variant_headers, 1):
-                cell = variant_ws.cell(row=1, column=col, value=header)
-                cell.font = Font(bold=True)
-                cell.fill = PatternFill(start_color="DDEBF7", end_color="DDEBF7", fill_type="solid")
-                cell.border = Border(bottom=Side(style='medium'))
+            header_row = []
+            for header in variant_headers:
+                cell = WriteOnlyCell(variant_ws, value=header)
+                cell.font = HEADER_FONT
+                cell.fill = HEADER_FILL
+                cell.border = HEADER_BORDER
+                header_row.append(cell)
             
             # Reorder variant data to put Samples at the end
             reordered_variant_data = []
@@ -213,10 +292,14 @@ def generate_excel_report(mutations_df, output_file):
                 # New order: [variant_name, sample_count, mutation_count, mutation_summary, sample_list]
                 reordered_variant_data.append([row[0], row[1], row[3], row[4], row[2]])
             
+            # The Samples column is capped at 100 characters wide
+            variant_df = pd.DataFrame(reordered_variant_data, columns=variant_headers)
+            set_column_widths(variant_ws, variant_df, variant_headers, max_widths={4: 100})
+            variant_ws.append(header_row)
+            
             # Add data
-            for r_idx, row in enumerate(reordered_variant_data, 2):
-                for c_idx, value in enumerate(row, 1):
-                    variant_ws.cell(row=r_idx, column=c_idx, value=value)
+            for row in reordered_variant_data:
+                variant_ws.append(row)
             print("Variant Analysis sheet completed")
         except Exception as e:
             print(f"Error creating Variant Analysis sheet: {e}")
@@ -224,33 +307,6 @@ def generate_excel_report(mutations_df, output_file):
         # Before saving
         print(f"Workbook has {len(wb.worksheets)} sheets: {[ws.title for ws in wb.worksheets]}")
         
-        # Auto-adjust column widths for all sheets
-        for sheet in wb.worksheets:
-            column_widths = {}
-            for row in sheet.rows:
-                for i, cell in enumerate(row):
-                    if isinstance(cell, MergedCell):
-                        continue
-                    if cell.value:
-                        # Get the column letter from the cell's coordinate
-                        column_letter = cell.column_letter
-                        # Calculate the length of the cell value
-                        try:
-                            if sheet.title == "Variant Analysis" and i == 4:  # Mutations column (0-based index)
-                                cell_length = min(len(str(cell.value)), 100)
-                            else:
-                                cell_length = len(str(cell.value))
-                            
-                            # Update the width if this cell is wider than what we've seen so far
-                            current_width = column_widths.get(column_letter, 0)
-                            column_widths[column_letter] = max(current_width, cell_length)
-                        except:
-                            pass
-            
-            # Set column widths with some padding
-            for col_letter, width in column_widths.items():
-                sheet.column_dimensions[col_letter].width = width + 2
-        
         # Save workbook
         wb.save(output_file)
         return output_file
@@ -258,44 +314,52 @@ def generate_excel_report(mutations_df, output_file):
         print(f"Error generating Excel report: {e}")
         return None
 
+def reset_figure(fig, figsize):
+    """Clear a figure for reuse and give it a fresh axes of the given size."""
+    fig.clf()
+    fig.set_size_inches(figsize)
+    return fig.add_subplot()
+
 def generate_mutation_plots(mutations_df, output_dir):
     """Generate plots visualizing the mutation data."""
     os.makedirs(output_dir, exist_ok=True)
     
-    # 1. Mutation distribution by sample
-    plt.figure(figsize=(10, 6))
+    # Compute the plotted statistics up front
     sample_counts = mutations_df.groupby('sample').size().sort_values(ascending=False)
-    sns.barplot(x=sample_counts.index, y=sample_counts.values, width=0.5)
-    plt.title('Mutations per Sample')
-    plt.xlabel('Sample')
-    plt.ylabel('Number of Mutations')
-    plt.xticks(rotation=45, ha='right')
+    mutation_types = mutations_df['mutation_type'].value_counts()
+    
+    # A single figure is reused for all plots so figure setup is paid once
+    fig = plt.figure()
+    
+    # 1. Mutation distribution by sample
+    ax = reset_figure(fig, (10, 6))
+    sns.barplot(x=sample_counts.index, y=sample_counts.values, width=0.5, ax=ax)
+    ax.set_title('Mutations per Sample')
+    ax.set_xlabel('Sample')
+    ax.set_ylabel('Number of Mutations')
+    plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
     
     # Format y-axis to show only integers
-    from matplotlib.ticker import MaxNLocator
-    plt.gca().yaxis.set_major_locator(MaxNLocator(integer=True))
+    ax.yaxis.set_major_locator(MaxNLocator(integer=True))
     
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, 'mutations_per_sample.png'))
-    plt.close()
+    fig.tight_layout()
+    fig.savefig(os.path.join(output_dir, 'mutations_per_sample.png'))
     
     # 2. Silent vs Missense mutations
-    plt.figure(figsize=(8, 8))
-    mutation_types = mutations_df['mutation_type'].value_counts()
-    plt.pie(mutation_types, labels=mutation_types.index, autopct='%1.1f%%', 
-            colors=['#E2EFDA', '#FCE4D6'])
-    plt.title('Distribution of Mutation Types')
-    plt.savefig(os.path.join(output_dir, 'mutation_types.png'))
-    plt.close()
+    ax = reset_figure(fig, (8, 8))
+    ax.pie(mutation_types, labels=mutation_types.index, autopct='%1.1f%%', 
+           colors=['#E2EFDA', '#FCE4D6'])
+    ax.set_title('Distribution of Mutation Types')
+    fig.savefig(os.path.join(output_dir, 'mutation_types.png'))
     
     # 3. Mutation positions along the sequence
-    plt.figure(figsize=(12, 6))
-    sns.histplot(data=mutations_df, x='nucleotide_position', bins=30, binwidth=0.5, color='#6699CC')
-    plt.title('Distribution of Mutations Along the Sequence')
-    plt.xlabel('Nucleotide Position')
-    plt.ylabel('Number of Mutations')
-    plt.savefig(os.path.join(output_dir, 'mutation_positions.png'))
-    plt.close()
+    ax = reset_figure(fig, (12, 6))
+    sns.histplot(data=mutations_df, x='nucleotide_position', bins=30, binwidth=0.5, color='#6699CC', ax=ax)
+    ax.set_title('Distribution of Mutations Along the Sequence')
+    ax.set_xlabel('Nucleotide Position')
+    ax.set_ylabel('Number of Mutations')
+    fig.savefig(os.path.join(output_dir, 'mutation_positions.png'))
+    plt.close(fig)
     
     return output_dir
 
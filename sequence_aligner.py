@@ -1,134 +1,243 @@
 import os
 import argparse
+import numpy as np
 import pandas as pd
-from Bio import SeqIO, Seq, SeqRecord
+from Bio import SeqIO, SeqRecord
 from Bio.Align import PairwiseAligner
 from Bio.Data import CodonTable
 import glob
+import itertools
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import xlsxwriter
+
+try:
+    import parasail
+except ImportError:  # Fall back to Biopython's scalar aligner
+    parasail = None
+
+# ABIF file header ('ABIF' marker, version) and 28-byte directory entries:
+# tag name, tag number, element type, element size, element count, data size, data offset, handle
+ABIF_HEADER = struct.Struct('>4sH')
+ABIF_DIR_ENTRY = struct.Struct('>4sI2H4I')
+
+# 2-bit base codes (A=0, C=1, G=2, T=3); any other byte maps to 4
+BASE2BIT = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    BASE2BIT[base] = code
+
+# Amino acid for every packed codon index (b0 << 4 | b1 << 2 | b2); stop codons are 'X'
+CODON_LUT = np.array([CodonTable.standard_dna_table.forward_table.get(''.join(codon), "X")
+                      for codon in itertools.product('ACGT', repeat=3)], dtype='U1')
+
+# Complement of every IUPAC nucleotide code, applied at C speed by bytes.translate
+RC_TBL = bytes.maketrans(b'ACGTNRYKMSWBDHVacgtnrykmswbdhv', b'TGCANYRMKSWVHDBtgcanyrmkswvhdb')
+
+# Scoring is fixed, so one aligner is shared by all samples
+ALIGNER = PairwiseAligner()
+ALIGNER.mode = 'global'
+# Medium stringency settings
+ALIGNER.match_score = 2
+ALIGNER.mismatch_score = -1
+ALIGNER.open_gap_score = -2
+ALIGNER.extend_gap_score = -0.5
+
+# The same scoring for parasail's SIMD aligner, doubled to keep it integral
+if parasail is not None:
+    # Same alphabet as RC_TBL so IUPAC mixed-base calls score as ordinary letters
+    PARASAIL_MATRIX = parasail.matrix_create("ACGTNRYKMSWBDHV", 4, -2)
+    PARASAIL_OPEN = 4
+    PARASAIL_EXTEND = 1
+
+def fast_parse_ab1_bases(file_path):
+    """Read only the basecaller sequence (PBAS2) from an AB1 file's ABIF directory."""
+    with open(file_path, 'rb') as handle:
+        marker, _ = ABIF_HEADER.unpack(handle.read(ABIF_HEADER.size))
+        if marker != b'ABIF':
+            raise ValueError(f"{file_path} is not an ABIF file")
+        
+        # The root entry points at the tag directory
+        root = ABIF_DIR_ENTRY.unpack(handle.read(ABIF_DIR_ENTRY.size))
+        entry_size, entry_count, dir_offset = root[3], root[4], root[6]
+        handle.seek(dir_offset)
+        directory = handle.read(entry_size * entry_count)
+        
+        for start in range(0, entry_size * entry_count, entry_size):
+            name, number, _, _, _, data_size, data_offset, _ = ABIF_DIR_ENTRY.unpack_from(directory, start)
+            if name == b'PBAS' and number == 2:
+                # Data of up to 4 bytes is stored in the offset field itself
+                if data_size <= 4:
+                    return directory[start + 20:start + 20 + data_size].decode()
+                handle.seek(data_offset)
+                return handle.read(data_size).decode()
+    
+    raise ValueError(f"No PBAS2 tag in {file_path}")
 
 def parse_ab1_file(file_path, trim_start=50):
     """Parse AB1 file and return the trimmed sequence."""
     try:
-        record = SeqIO.read(file_path, "abi")
+        seq = fast_parse_ab1_bases(file_path)
+    except (OSError, ValueError, struct.error):
+        seq = None
+    
+    try:
+        if seq is None:
+            # Fall back to Biopython's full ABIF parser
+            record = SeqIO.read(file_path, "abi")
+            seq = str(record.seq)
         # Trim the first 50 nucleotides
-        trimmed_seq = record.seq[trim_start:]
-        return str(trimmed_seq)
+        return seq[trim_start:]
     except Exception as e:
         print(f"Error parsing {file_path}: {e}")
         return None
 
-def detect_orientation(seq, ref_seq, aligner):
+def revcomp(seq):
+    """Return the reverse complement of a nucleotide string."""
+    return seq.encode().translate(RC_TBL)[::-1].decode()
+
+def score_alignment(seq, ref_seq):
+    """Score the global alignment of seq against ref_seq without a traceback."""
+    if parasail is not None:
+        return parasail.nw_striped_sat(seq, ref_seq, PARASAIL_OPEN, PARASAIL_EXTEND,
+                                       PARASAIL_MATRIX).score
+    return ALIGNER.score(seq, ref_seq)
+
+def detect_orientation(seq, ref_seq):
     """Detect if sequence is forward or reverse complement."""
     
-    forward_score = aligner.score(seq, ref_seq)
-    reverse_seq = str(Seq.Seq(seq).reverse_complement())
-    reverse_score = aligner.score(reverse_seq, ref_seq)
+    forward_score = score_alignment(seq, ref_seq)
+    reverse_seq = revcomp(seq)
+    reverse_score = score_alignment(reverse_seq, ref_seq)
     
     if reverse_score > forward_score:
-        return "reverse", reverse_seq
+        return "reverse", reverse_seq, reverse_score
     else:
-        return "forward", seq
+        return "forward", seq, forward_score
 
 def align_sequence(seq, ref_seq, min_aligned_length=50):
     """Align sequence to reference sequence."""
-    aligner = PairwiseAligner()
-    aligner.mode = 'global'
-    # Medium stringency settings
-    aligner.match_score = 2
-    aligner.mismatch_score = -1
-    aligner.open_gap_score = -2
-    aligner.extend_gap_score = -0.5
-    
     # Detect orientation
-    orientation, oriented_seq = detect_orientation(seq, ref_seq, aligner)
+    orientation, oriented_seq, _ = detect_orientation(seq, ref_seq)
     
     # Perform alignment
-    alignments = aligner.align(oriented_seq, ref_seq)
-    best_alignment = alignments[0]
+    if parasail is not None:
+        result = parasail.nw_trace_striped_sat(oriented_seq, ref_seq, PARASAIL_OPEN,
+                                               PARASAIL_EXTEND, PARASAIL_MATRIX)
+        best_alignment = (result.traceback.query, result.traceback.ref)
+    else:
+        alignments = ALIGNER.align(oriented_seq, ref_seq)
+        best_alignment = alignments[0]
     
     return best_alignment, orientation
 
+def translate_codons(codon_bytes):
+    """Translate an (n, 3) uint8 array of codon bases to amino acids using CODON_LUT."""
+    bits = BASE2BIT[codon_bytes]
+    idx = (bits[:, 0] << 4) | (bits[:, 1] << 2) | bits[:, 2]
+    amino_acids = CODON_LUT[idx & 63]
+    # Codons with ambiguous or missing bases cannot be translated
+    amino_acids[(bits > 3).any(axis=1)] = "X"
+    return amino_acids
+
 def find_mutations(alignment, ref_seq):
     """Find mutations between aligned sequence and reference."""
-    aligned_seq, aligned_ref = alignment[0], alignment[1]
-    mutations = []
+    aligned_seq = np.frombuffer(str(alignment[0]).encode(), dtype=np.uint8)
+    aligned_ref = np.frombuffer(str(alignment[1]).encode(), dtype=np.uint8)
+    gap = ord('-')
     
-    seq_pos = 0
-    ref_pos = 0
+    # Substitutions only: both columns must be bases and differ
+    ref_is_base = aligned_ref != gap
+    mask = (aligned_seq != aligned_ref) & (aligned_seq != gap) & ref_is_base
     
-    for i in range(len(aligned_seq)):
-        seq_char = aligned_seq[i]
-        ref_char = aligned_ref[i]
-        
-        if seq_char != '-':
-            seq_pos += 1
-        
-        if ref_char != '-':
-            ref_pos += 1
-            
-        if seq_char != ref_char and seq_char != '-' and ref_char != '-':
-            mutations.append({
-                'ref_pos': ref_pos,
-                'ref_base': ref_char,
-                'seq_base': seq_char
-            })
-    
-    return mutations
-
-def analyze_codon_changes(mutations, ref_seq):
+    # 1-based reference position of every alignment column
+    ref_pos = np.cumsum(ref_is_base)
+    
+    return {
+        'ref_pos': ref_pos[mask],
+        'ref_base': aligned_ref[mask].view('S1').astype('U1'),
+        'seq_base': aligned_seq[mask].view('S1').astype('U1')
+    }
+
+def analyze_codon_changes(mutations, ref_seq, ref_bytes=None):
     """Analyze codon changes and amino acid impacts."""
+    if ref_bytes is None:
+        ref_bytes = np.frombuffer(ref_seq.encode(), dtype=np.uint8)
+    
+    # Skip mutations in an incomplete codon at the end of the reference
+    mut_codons = (mutations['ref_pos'] - 1) // 3
+    complete = mut_codons * 3 + 3 <= len(ref_bytes)
+    mut_codons = mut_codons[complete]
+    codon_index = (mutations['ref_pos'][complete] - 1) % 3
+    seq_bases = mutations['seq_base'][complete].astype('S1').view(np.uint8)
+    
     # Group mutations by codon position
-    codon_mutations = {}
-    
-    for mut in mutations:
-        ref_pos = mut['ref_pos']
-        codon_pos = (ref_pos - 1) // 3
-        if codon_pos not in codon_mutations:
-            codon_mutations[codon_pos] = []
-        codon_mutations[codon_pos].append(mut)
-    
-    # Analyze each affected codon
-    standard_table = CodonTable.standard_dna_table
-    mutation_results = []
-    
-    for codon_pos, muts in codon_mutations.items():
-        # Get original codon
-        start_pos = codon_pos * 3
-        orig_codon = ref_seq[start_pos:start_pos+3]
-        
-        if len(orig_codon) < 3:
-            continue  # Skip incomplete codons
-        
-        # Create mutated codon
-        mutated_codon = list(orig_codon)
-        for mut in muts:
-            codon_index = (mut['ref_pos'] - 1) % 3
-            mutated_codon[codon_index] = mut['seq_base']
-        
-        mutated_codon = ''.join(mutated_codon)
+    codon_positions = np.unique(mut_codons)
+    
+    # Get original codons as an (n, 3) array of reference bytes
+    orig_codons = ref_bytes[codon_positions[:, None] * 3 + np.arange(3)]
+    
+    # Create mutated codons
+    mutated_codons = orig_codons.copy()
+    mutated_codons[np.searchsorted(codon_positions, mut_codons), codon_index] = seq_bases
+    
+    # Translate codons to amino acids
+    original_aa = translate_codons(orig_codons)
+    mutated_aa = translate_codons(mutated_codons)
+    is_silent = original_aa == mutated_aa
+    
+    codon_positions = codon_positions + 1  # 1-based position
+    
+    return {
+        'codon_position': codon_positions,
+        'nucleotide_position': codon_positions * 3 - 2,  # 1-based position
+        'original_codon': orig_codons.view('S3').ravel().astype('U3'),
+        'mutated_codon': mutated_codons.view('S3').ravel().astype('U3'),
+        'original_aa': original_aa,
+        'mutated_aa': mutated_aa,
+        'aa_position': codon_positions,
+        'is_silent': is_silent,
+        'mutation_type': np.where(is_silent, 'Silent', 'Missense')
+    }
+
+def process_ab1_file(ab1_file, ref_seq, trim_start=50, min_aligned_length=50, ref_bytes=None):
+    """Parse, align and analyze a single AB1 file; returns its codon results."""
+    sample_name = os.path.basename(ab1_file).split('.')[0]
+    print(f"Processing {sample_name}...")
+    
+    # Parse AB1 file
+    seq = parse_ab1_file(ab1_file, trim_start)
+    if not seq:
+        return None
         
-        # Translate codons to amino acids
-        try:
-            orig_aa = standard_table.forward_table.get(orig_codon, "X")
-            mutated_aa = standard_table.forward_table.get(mutated_codon, "X")
-            
-            is_silent = (orig_aa == mutated_aa)
-            
-            mutation_results.append({
-                'codon_position': codon_pos + 1,  # 1-based position
-                'nucleotide_position': start_pos + 1,  # 1-based position
-                'original_codon': orig_codon,
-                'mutated_codon': mutated_codon,
-                'original_aa': orig_aa,
-                'mutated_aa': mutated_aa,
-                'aa_position': codon_pos + 1,  # 1-based position
-                'is_silent': is_silent,
-                'mutation_type': 'Silent' if is_silent else 'Missense'
-            })
-        except Exception as e:
-            print(f"Error analyzing codon {orig_codon} -> {mutated_codon}: {e}")
-    
-    return mutation_results
+    # Align sequence
+    alignment, orientation = align_sequence(seq, ref_seq, min_aligned_length)
+    
+    # Find mutations
+    mutations = find_mutations(alignment, ref_seq)
+    
+    # Analyze codon changes
+    codon_results = analyze_codon_changes(mutations, ref_seq, ref_bytes)
+    
+    # Add sample information
+    n = len(codon_results['nucleotide_position'])
+    codon_results['sample'] = np.full(n, sample_name)
+    codon_results['orientation'] = np.full(n, orientation)
+    return codon_results
+
+def write_mutations_excel(df, output_file):
+    """Write the mutation table to Excel row by row using xlsxwriter's constant-memory mode."""
+    # Constant-memory mode keeps only the current row, so rows must be written in order;
+    # pandas' to_excel writes column by column and would lose data in this mode
+    workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    
+    worksheet.write_row(0, 0, df.columns, header_format)
+    for r_idx, row in enumerate(df.itertuples(index=False, name=None), 1):
+        worksheet.write_row(r_idx, 0, row)
+    
+    workbook.close()
 
 def main():
     parser = argparse.ArgumentParser(description='Sequence Aligner for AB1 files')
@@ -137,12 +246,14 @@ def main():
     parser.add_argument('--output', default='mutations.xlsx', help='Output Excel file')
     parser.add_argument('--trim', type=int, default=50, help='Number of nucleotides to trim from start')
     parser.add_argument('--min_length', type=int, default=50, help='Minimum aligned read length')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: CPU count)')
     
     args = parser.parse_args()
     
     # Load reference sequence
     ref_record = SeqIO.read(args.ref, "fasta")
     ref_seq = str(ref_record.seq)
+    ref_bytes = np.frombuffer(ref_seq.encode(), dtype=np.uint8)
     
     # Find all AB1 files
     ab1_files = glob.glob(os.path.join(args.input, "*.ab1"))
@@ -151,46 +262,32 @@ def main():
         print(f"No AB1 files found in {args.input}")
         return
     
-    all_results = []
+    # Reorder columns for better readability
+    columns = ['sample', 'orientation', 'nucleotide_position', 'original_codon', 
+              'mutated_codon', 'aa_position', 'original_aa', 'mutated_aa', 
+              'is_silent', 'mutation_type']
     
-    for ab1_file in ab1_files:
-        sample_name = os.path.basename(ab1_file).split('.')[0]
-        print(f"Processing {sample_name}...")
-        
-        # Parse AB1 file
-        seq = parse_ab1_file(ab1_file, args.trim)
-        if not seq:
-            continue
-            
-        # Align sequence
-        alignment, orientation = align_sequence(seq, ref_seq, args.min_length)
-        
-        # Find mutations
-        mutations = find_mutations(alignment, ref_seq)
-        
-        # Analyze codon changes
-        codon_results = analyze_codon_changes(mutations, ref_seq)
-        
-        # Add sample information
-        for result in codon_results:
-            result['sample'] = sample_name
-            result['orientation'] = orientation
-            all_results.append(result)
+    # One list of per-sample arrays for each output column
+    all_results = {col: [] for col in columns}
+    
+    # Samples are independent, so process them in parallel
+    process = partial(process_ab1_file, ref_seq=ref_seq, trim_start=args.trim,
+                      min_aligned_length=args.min_length, ref_bytes=ref_bytes)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for codon_results in executor.map(process, ab1_files):
+            if codon_results is None:
+                continue
+            for col in columns:
+                all_results[col].append(codon_results[col])
     
     # Create DataFrame and export to Excel
-    if all_results:
-        df = pd.DataFrame(all_results)
-        
-        # Reorder columns for better readability
-        columns = ['sample', 'orientation', 'nucleotide_position', 'original_codon', 
-                  'mutated_codon', 'aa_position', 'original_aa', 'mutated_aa', 
-                  'is_silent', 'mutation_type']
-        
-        df = df[columns]
+    if sum(len(arr) for arr in all_results['sample']):
+        df = pd.DataFrame({col: np.concatenate(arrs) for col, arrs in all_results.items()})
+        # The report generator relies on this order to skip re-sorting
         df.sort_values(['sample', 'nucleotide_position'], inplace=True)
         
         # Export to Excel
-        df.to_excel(args.output, index=False)
+        write_mutations_excel(df, args.output)
         print(f"Results exported to {args.output}")
     else:
         print("No mutations found.")